@@ -318,3 +318,28 @@ base64_decode(const uint32_t *src, size_t src_sz, uint8_t *dest, size_t dest_cap
     }
     return NULL;
 }
+
+static const char b64_encoding_table[65] = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/";
+
+void
+base64_encode(const uint8_t *src, size_t src_sz, uint8_t *dest, size_t *dest_sz) {
+    // dest must have a capacity of at least 4 * ((src_sz + 2) / 3) bytes
+    size_t i = 0, j = 0;
+    while (i + 2 < src_sz) {
+        uint32_t triple = (src[i] << 2 * 8) | (src[i + 1] << 1 * 8) | src[i + 2];
+        i += 3;
+        dest[j++] = b64_encoding_table[(triple >> 3 * 6) & 0x3F];
+        dest[j++] = b64_encoding_table[(triple >> 2 * 6) & 0x3F];
+        dest[j++] = b64_encoding_table[(triple >> 1 * 6) & 0x3F];
+        dest[j++] = b64_encoding_table[(triple >> 0 * 6) & 0x3F];
+    }
+    if (i < src_sz) {
+        uint32_t triple = src[i] << 2 * 8;
+        if (i + 1 < src_sz) triple |= src[i + 1] << 1 * 8;
+        dest[j++] = b64_encoding_table[(triple >> 3 * 6) & 0x3F];
+        dest[j++] = b64_encoding_table[(triple >> 2 * 6) & 0x3F];
+        dest[j++] = i + 1 < src_sz ? b64_encoding_table[(triple >> 1 * 6) & 0x3F] : '=';
+        dest[j++] = '=';
+    }
+    *dest_sz = j;
+}
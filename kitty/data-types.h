@@ -285,6 +285,7 @@ typedef struct {FONTS_DATA_HEAD} *FONTS_DATA_HANDLE;
 
 // Global functions
 const char* base64_decode(const uint32_t *src, size_t src_sz, uint8_t *dest, size_t dest_capacity, size_t *dest_sz);
+void base64_encode(const uint8_t *src, size_t src_sz, uint8_t *dest, size_t *dest_sz);
 Line* alloc_line(void);
 Cursor* alloc_cursor(void);
 LineBuf* alloc_linebuf(unsigned int, unsigned int);
@@ -294,6 +295,7 @@ void copy_color_profile(ColorProfile*, ColorProfile*);
 PyObject* create_256_color_table(void);
 PyObject* parse_bytes_dump(PyObject UNUSED *, PyObject *);
 PyObject* parse_bytes(PyObject UNUSED *, PyObject *);
+PyObject* send_graphics_cmd(PyObject UNUSED *, PyObject *);
 void cursor_reset(Cursor*);
 Cursor* cursor_copy(Cursor*);
 void cursor_copy_to(Cursor *src, Cursor *dest);
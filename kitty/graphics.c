@@ -993,18 +993,21 @@ W(image_for_client_number) {
 }
 
 W(shm_write) {
-    const char *name, *data;
-    Py_ssize_t sz;
-    PA("ss#", &name, &data, &sz);
+    const char *name;
+    Py_buffer data;
+    PA("sy*", &name, &data);
+#define FAIL { safe_close(fd, __FILE__, __LINE__); PyBuffer_Release(&data); PyErr_SetFromErrnoWithFilename(PyExc_OSError, name); return NULL; }
     int fd = shm_open(name, O_CREAT | O_RDWR, S_IRUSR | S_IWUSR);
-    if (fd == -1) { PyErr_SetFromErrnoWithFilename(PyExc_OSError, name); return NULL; }
-    int ret = ftruncate(fd, sz);
-    if (ret != 0) { safe_close(fd, __FILE__, __LINE__); PyErr_SetFromErrnoWithFilename(PyExc_OSError, name); return NULL; }
-    void *addr = mmap(0, sz, PROT_WRITE, MAP_SHARED, fd, 0);
-    if (addr == MAP_FAILED) { safe_close(fd, __FILE__, __LINE__); PyErr_SetFromErrnoWithFilename(PyExc_OSError, name); return NULL; }
-    memcpy(addr, data, sz);
-    if (munmap(addr, sz) != 0) { safe_close(fd, __FILE__, __LINE__); PyErr_SetFromErrnoWithFilename(PyExc_OSError, name); return NULL; }
+    if (fd == -1) { PyBuffer_Release(&data); PyErr_SetFromErrnoWithFilename(PyExc_OSError, name); return NULL; }
+    int ret = ftruncate(fd, data.len);
+    if (ret != 0) FAIL;
+    void *addr = mmap(0, data.len, PROT_WRITE, MAP_SHARED, fd, 0);
+    if (addr == MAP_FAILED) FAIL;
+    memcpy(addr, data.buf, data.len);
+    if (munmap(addr, data.len) != 0) FAIL;
+#undef FAIL
     safe_close(fd, __FILE__, __LINE__);
+    PyBuffer_Release(&data);
     Py_RETURN_NONE;
 }
 
@@ -1368,6 +1368,36 @@ FNAME(parse_bytes)(PyObject UNUSED *self, PyObject *args) {
     Py_RETURN_NONE;
 }
 
+#ifndef DUMP_COMMANDS
+PyObject*
+send_graphics_cmd(PyObject UNUSED *self, PyObject *args) {
+    // assemble an escape wrapped graphics command, base64 encoding the
+    // payload in C, and feed it to the parser without a Python level
+    // intermediate copy
+    Py_buffer cmd = {0}, payload = {0};
+    Screen *screen;
+    if (!PyArg_ParseTuple(args, "O!y*|y*", &Screen_Type, &screen, &cmd, &payload)) return NULL;
+    size_t encoded_capacity = payload.len > 0 ? 4 * (((size_t)payload.len + 2) / 3) : 0;
+    size_t sz = 3 + (size_t)cmd.len + 1 + encoded_capacity + 2, pos = 0;
+    uint8_t *buf = malloc(sz);
+    if (buf == NULL) { PyBuffer_Release(&cmd); PyBuffer_Release(&payload); return PyErr_NoMemory(); }
+    memcpy(buf + pos, "\x1b_G", 3); pos += 3;
+    memcpy(buf + pos, cmd.buf, cmd.len); pos += cmd.len;
+    if (payload.len > 0) {
+        buf[pos++] = ';';
+        size_t encoded_sz;
+        base64_encode(payload.buf, payload.len, buf + pos, &encoded_sz);
+        pos += encoded_sz;
+    }
+    buf[pos++] = 0x1b; buf[pos++] = '\\';
+    do_parse_bytes(screen, buf, pos, monotonic(), NULL);
+    free(buf);
+    PyBuffer_Release(&cmd); PyBuffer_Release(&payload);
+    if (PyErr_Occurred()) return NULL;
+    Py_RETURN_NONE;
+}
+#endif
+
 
 void
 FNAME(parse_worker)(Screen *screen, PyObject *dump_callback, monotonic_t now) {
@@ -2272,6 +2272,14 @@ clear_selection_(Screen *s, PyObject *args UNUSED) {
 }
 
 WRAP0x(index)
+static PyObject*
+index_n(Screen *self, PyObject *args) {
+    // perform the index action n times with a single interpreter crossing
+    unsigned int n = 1;
+    if (!PyArg_ParseTuple(args, "|I", &n)) return NULL;
+    while (n--) screen_index(self);
+    Py_RETURN_NONE;
+}
 WRAP0(reverse_index)
 WRAP0(reset)
 WRAP0(set_tab_stop)
@@ -2833,6 +2841,7 @@ static PyMethodDef methods[] = {
     MND(cursor_down1, METH_VARARGS)
     MND(cursor_forward, METH_VARARGS)
     {"index", (PyCFunction)xxx_index, METH_VARARGS, ""},
+    MND(index_n, METH_VARARGS)
     MND(set_pending_timeout, METH_O)
     MND(as_text, METH_VARARGS)
     MND(as_text_non_visual, METH_VARARGS)